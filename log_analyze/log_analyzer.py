@@ -4,14 +4,27 @@ import logging
 import argparse
 import json
 import os
-import re
+import sys
 from statistics import median
-import gzip
+import zlib
 import datetime
-from collections import namedtuple
-from string import Template
+import heapq
+from array import array
+from collections import defaultdict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+from itertools import repeat
 from log_analyze.definitions import ROOT_DIR
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 logger = logging.getLogger('DefaultLogger')
 config = {
@@ -23,12 +36,36 @@ config = {
 }
 
 LogFile = namedtuple('LogFile', ['name', 'date'])
+LOG_PREFIX = 'nginx-access-ui.log-'
+LOG_EXTENSIONS = ('', '.gz')
+REPORT_PLACEHOLDER = b'$table_json'
+HTTP_METHODS = frozenset((b'GET', b'POST', b'PUT', b'HEAD'))
+HTTP_PROTOCOLS = frozenset((b'HTTP/1.0', b'HTTP/1.1'))
+READ_SIZE = 1024 * 1024
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+NUMPY_MEDIAN_MIN_SIZE = 32
+PARALLEL_METRICS_MIN_URLS = 50000
+PARALLEL_PARSE_MIN_SIZE = 8 * 1024 * 1024
+
+
+@lru_cache(maxsize=16)
+def load_config_file(config_path, mtime):
+    """function that reads config file, results are cached by path and modification time.
+    Args:
+        config_path (str): config file path.
+        mtime (int): modification time of config file in nanoseconds.
+
+    Returns:
+        dict with parameters from config file.
+
+    """
+    with open(config_path, 'rb') as f:
+        return json.loads(f.read()) if orjson is None else orjson.loads(f.read())
 
 
 def update_config(new_config_path, default_config):
-    with open(new_config_path, 'r') as f:
-        new_config = json.load(f)
-        default_config.update(new_config)
+    new_config = load_config_file(new_config_path, os.stat(new_config_path).st_mtime_ns)
+    default_config.update(new_config)
 
 
 def logger_setup(config_file):
@@ -60,67 +97,199 @@ def find_latest_log(config_file):
     log_dir = os.path.join(ROOT_DIR, config_file['LOG_DIR'])
     logger.info(f'set values LOG_DIR is {log_dir}')
     logger.info('looking for the latest nginx log...')
-    regex = re.compile('nginx-access-ui.log-(?P<date>\d+).*(?:gz|$)')
-    latest_date = datetime.date.min
+    latest_date = ''
     latest_file = ''
-    if not os.path.exists(log_dir):
+    try:
+        entries = os.scandir(log_dir)
+    except FileNotFoundError:
         logger.info(f'directory {log_dir} does not exist')
         return None
-    for i in os.listdir(log_dir):
-        data = re.search(regex, i)
-        if data:
-            date = datetime.datetime.strptime(data['date'], '%Y%m%d').date()
+    with entries:
+        for entry in entries:
+            name = entry.name
+            if not name.startswith(LOG_PREFIX):
+                continue
+            date, extension = name[len(LOG_PREFIX):len(LOG_PREFIX) + 8], name[len(LOG_PREFIX) + 8:]
+            if extension not in LOG_EXTENSIONS or len(date) != 8 or not date.isdigit():
+                continue
             if date > latest_date:
                 latest_date = date
-                latest_file = os.path.join(log_dir, i)
-    if latest_date > datetime.date.min:
-
-        last_log = LogFile(latest_file, latest_date)
+                latest_file = os.path.join(log_dir, name)
+    if latest_date:
+        date = datetime.date(int(latest_date[:4]), int(latest_date[4:6]), int(latest_date[6:]))
+        last_log = LogFile(latest_file, date)
         logger.info(f'found the new last file: {latest_file}')
         return last_log
 
 
-def parse_log(file):
+def read_lines(file, start=0, end=None):
+    """function of reading the log file in batches of lines.
+    The file is read in big blocks, gzipped files are decompressed on the fly.
+    Args:
+        file (str): log file path.
+        start (int): offset of the first byte to read, plain files only.
+        end (int): offset after the last byte to read, plain files only.
+
+    Yields:
+        list of lines read from one block of the file.
+
+    """
+    decompressor = zlib.decompressobj(GZIP_WBITS) if file.endswith('.gz') else None
+    leftover = b''
+    with open(file, 'rb', buffering=0) as f:
+        f.seek(start)
+        if end is None:
+            blocks = iter(partial(f.read, READ_SIZE), b'')
+        else:
+            blocks = iter(lambda: f.read(min(READ_SIZE, end - f.tell())), b'')
+        for data in blocks:
+            if decompressor is not None:
+                chunk = b''
+                while data:
+                    if decompressor.eof:
+                        data = data.lstrip(b'\0')
+                        if not data:
+                            break
+                        decompressor = zlib.decompressobj(GZIP_WBITS)
+                    chunk += decompressor.decompress(data)
+                    data = decompressor.unused_data
+                data = chunk
+            *lines, leftover = (leftover + data).split(b'\n')
+            if lines:
+                yield lines
+        if decompressor is not None and f.tell() and not decompressor.eof:
+            raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+    if leftover:
+        yield [leftover]
+
+
+def parse_lines(lines):
+    """function of parsing a batch of nginx log lines.
+    Args:
+        lines (list): raw lines of the log.
+
+    Returns:
+        list with (url, request_time) pairs of parsed lines.
+
+    """
+    pairs = []
+    for line in lines:
+        parts = line.split(b'"', 2)
+        if len(parts) < 3:
+            continue
+        method, _, request = parts[1].partition(b' ')
+        url, _, protocol = request.rpartition(b' ')
+        if not url or method not in HTTP_METHODS or protocol not in HTTP_PROTOCOLS:
+            continue
+        request_time = line.rstrip().rpartition(b' ')[2]
+        whole, dot, fraction = request_time.partition(b'.')
+        if not dot or not whole.isdigit() or not fraction.isdigit():
+            continue
+        pairs.append((url, float(request_time)))
+    return pairs
+
+
+def parse_log(file, start=0, end=None):
     """function of parsing the specified nginx file.
+    Lines are parsed in batches, one batch per block of the file.
     Args:
         file (str): parsing file path.
+        start (int): offset of the first line to parse, plain files only.
+        end (int): offset after the last line to parse, plain files only.
+
+    Yields:
+        pairs: list with (url, request_time) pairs of parsed lines in batch.
+        summary_lines: count of lines read so far.
+        parsed_lines: count of lines parsed so far.
+
+    """
+    logger.info(f'starting to parse the file {file}')
+    parsed_lines = 0
+    summary_lines = 0
+    for lines in read_lines(file, start, end):
+        summary_lines += len(lines)
+        pairs = parse_lines(lines)
+        parsed_lines += len(pairs)
+        yield pairs, summary_lines, parsed_lines
+
+
+def split_log(file, parts):
+    """function of splitting the plain log into byte ranges aligned to lines.
+    Args:
+        file (str): plain log file path.
+        parts (int): wanted count of ranges.
+
+    Returns:
+        list of (start, end) offsets of ranges.
+
+    """
+    size = os.path.getsize(file)
+    bounds = [0]
+    with open(file, 'rb') as f:
+        for i in range(1, parts):
+            f.seek(max(size * i // parts, bounds[-1]))
+            f.readline()
+            bounds.append(f.tell())
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
+
+
+def collect_samples(log_parser):
+    """function that collects request times of each url from the log parser.
+    Args:
+        log_parser (generator): parse_log generator.
 
     Returns:
-        urls: dict with unique urls and their request times.
+        samples: dict with url bytes and array of their request times.
         summary_lines: count of lines in file
+        parsed_lines: count of parsed lines in file
         requests_time: summary requests time of all urls in file.
 
     """
-    logger.info(f'starting to parse the file {file}')
-    opener = gzip.open if file.endswith('.gz') else open
-    line_format = re.compile(
-        b'.*((\"(GET|POST|PUT|HEAD) )(?P<url>.+)(http\/1\.[0-1]")).* (?P<request_time>\d+\.\d+)', re.IGNORECASE)
-    with opener(file, 'rb') as f:
-        logger.info('successfully read the file, start parsing')
-        parsed_lines = 0
-        summary_lines = 0
-        for line in f:
-            summary_lines += 1
-            data = re.search(line_format, line)
-            if data:
-                parsed_lines += 1
-                yield data, summary_lines, parsed_lines
+    samples = defaultdict(partial(array, 'd'))
+    requests_time = 0
+    parsed_lines = 0
+    summary_lines = 0
+    for pairs, summary_lines, parsed_lines in log_parser:
+        for url, request_time in pairs:
+            requests_time += request_time
+            samples[url].append(request_time)
+    return samples, summary_lines, parsed_lines, requests_time
 
 
-def aggregate_parse_values(config_file, log_parser):
-    urls = {}
+def collect_log_range(file, start, end):
+    samples, summary_lines, parsed_lines, requests_time = collect_samples(parse_log(file, start, end))
+    return dict(samples), summary_lines, parsed_lines, requests_time
+
+
+def parse_log_parallel(file, workers=None):
+    """function of parsing the plain nginx file by parts in a process pool.
+    Args:
+        file (str): plain log file path.
+        workers (int): count of worker processes, cpu count by default.
+
+    Returns:
+        the same values as collect_samples for the whole file.
+
+    """
+    workers = workers or os.cpu_count() or 1
+    starts, ends = zip(*split_log(file, workers))
+    samples = defaultdict(partial(array, 'd'))
     requests_time = 0
     parsed_lines = 0
     summary_lines = 0
-    for data, summary_lines, parsed_lines in log_parser:
-        datadict = data.groupdict()
-        url = datadict["url"].decode('UTF-8')
-        request_time = float(datadict["request_time"])
-        requests_time += request_time
-        try:
-            urls[url].append(request_time)
-        except KeyError:
-            urls[url] = [request_time]
+    with ProcessPoolExecutor(workers) as executor:
+        for part in executor.map(collect_log_range, repeat(file), starts, ends):
+            part_samples, part_summary_lines, part_parsed_lines, part_requests_time = part
+            for url, times in part_samples.items():
+                samples[url].extend(times)
+            summary_lines += part_summary_lines
+            parsed_lines += part_parsed_lines
+            requests_time += part_requests_time
+    return samples, summary_lines, parsed_lines, requests_time
+
+
+def check_dropped(config_file, summary_lines, parsed_lines):
     dropped = round((summary_lines-parsed_lines) / summary_lines * 100, 3)
     max_drop = config_file['MAX_DROP']
     if dropped > max_drop:
@@ -129,14 +298,81 @@ def aggregate_parse_values(config_file, log_parser):
         raise RuntimeError(error_msg)
     else:
         logger.info(f'founded {dropped}% errors, it is ok, allowed:{max_drop}%')
+
+
+def decode_samples(samples):
+    """function that decodes url bytes of collected samples.
+    An invalid utf-8 byte and the same escape written literally in the url decode
+    to the same text, request times of such urls are merged.
+    Args:
+        samples (dict): dict with url bytes and array of their request times.
+
+    Returns:
+        dict with decoded urls and array of their request times.
+
+    """
+    urls = {}
+    for url, times in samples.items():
+        key = sys.intern(url.decode('utf-8', 'backslashreplace'))
+        if key in urls:
+            urls[key] = urls[key] + times
+        else:
+            urls[key] = times
+    return urls
+
+
+def summarize_samples(config_file, samples, summary_lines, parsed_lines, requests_time):
+    urls = {}
+    for url, times in decode_samples(samples).items():
+        urls[url] = [len(times), sum(times), max(times), times]
+    check_dropped(config_file, summary_lines, parsed_lines)
     return urls, summary_lines, requests_time
 
 
-def calculate_report_metrics(config_file, urls, summary_lines, requests_time):
-    """function that calculates different metrics for each url.
+def aggregate_parse_values(config_file, log_parser):
+    return summarize_samples(config_file, *collect_samples(log_parser))
+
+
+def calculate_medians(records):
+    """function that calculates median request time for each url.
+    With numpy the samples of urls with many requests are grouped by their
+    count into float64 blocks, every block gets its medians from a single
+    partition along rows, small samples are left to statistics.median.
     Args:
-        config_file (dict): dict with parameters for searching.
-        urls (dict): dict with unique urls and their request times.
+        records (list): [count, time_sum, time_max, request times] records of urls.
+
+    Returns:
+        list of medians in records order.
+
+    """
+    if np is None:
+        return [median(times) for _, _, _, times in records]
+    medians = []
+    blocks = defaultdict(list)
+    for i, (counter, _, _, times) in enumerate(records):
+        if counter < NUMPY_MEDIAN_MIN_SIZE:
+            medians.append(median(times))
+        else:
+            medians.append(None)
+            blocks[counter].append(i)
+    for counter, indexes in blocks.items():
+        block = np.frombuffer(b''.join(records[i][3].tobytes() for i in indexes), dtype=np.float64)
+        block = block.reshape(len(indexes), counter)
+        k = counter // 2
+        if counter % 2:
+            values = np.partition(block, k, axis=1)[:, k]
+        else:
+            block = np.partition(block, (k - 1, k), axis=1)
+            values = (block[:, k - 1] + block[:, k]) / 2
+        for i, value in zip(indexes, values.tolist()):
+            medians[i] = value
+    return medians
+
+
+def calculate_metrics_chunk(items, summary_lines, requests_time):
+    """function that calculates metrics for a part of urls.
+    Args:
+        items (list): (url, [count, time_sum, time_max, request times]) pairs.
         summary_lines (int): count of lines in file
         requests_time (float): summary requests time of all urls in file.
 
@@ -144,27 +380,118 @@ def calculate_report_metrics(config_file, urls, summary_lines, requests_time):
         table list with dicts with urls and their metrics values.
 
     """
-
-    logger.info('start calculating metrics')
     table = []
-    for key, value in urls.items():
+    medians = calculate_medians([record for _, record in items])
+    for (key, (counter, time_sum, time_max, _)), time_med in zip(items, medians):
         metrics = {}
-        counter = len(value)
         metrics['url'] = key
         metrics['count'] = counter
-        metrics['time_sum'] = sum(value)
-        metrics['time_avg'] = sum(value)/counter
-        metrics['time_max'] = max(value)
-        metrics['time_med'] = median(value)
+        metrics['time_sum'] = time_sum
+        metrics['time_avg'] = time_sum/counter
+        metrics['time_max'] = time_max
+        metrics['time_med'] = time_med
         metrics['count_perc'] = round(counter / summary_lines * 100, 3)
-        metrics['time_perc'] = round(sum(value) / requests_time * 100, 3)
+        metrics['time_perc'] = round(time_sum / requests_time * 100, 3)
         table.append(metrics)
-    if len(table) > config_file['REPORT_SIZE']:
-        logger.info("urls count more than report size settings, choose the highest priority")
-        table = sorted(table, key=lambda i: i['time_avg'], reverse=True)[:config_file['REPORT_SIZE']]
     return table
 
 
+def select_report_items(config_file, items):
+    """function that chooses urls with the highest average time for the report.
+    Args:
+        config_file (dict): dict with parameters for searching.
+        items (list): (url, [count, time_sum, time_max, request times]) pairs.
+
+    Returns:
+        at most REPORT_SIZE pairs.
+
+    """
+    if len(items) > config_file['REPORT_SIZE']:
+        logger.info("urls count more than report size settings, choose the highest priority")
+        items = heapq.nlargest(config_file['REPORT_SIZE'], items, key=lambda i: i[1][1] / i[1][0])
+    return items
+
+
+def calculate_table(items, summary_lines, requests_time):
+    """function that calculates metrics for chosen urls.
+    Large tables are split into chunks computed in a process pool.
+    Args:
+        items (list): (url, [count, time_sum, time_max, request times]) pairs.
+        summary_lines (int): count of lines in file
+        requests_time (float): summary requests time of all urls in file.
+
+    Returns:
+        table list with dicts with urls and their metrics values.
+
+    """
+    workers = os.cpu_count() or 1
+    if workers == 1 or len(items) < PARALLEL_METRICS_MIN_URLS:
+        return calculate_metrics_chunk(items, summary_lines, requests_time)
+    size = -(-len(items) // workers)
+    chunks = [items[i:i + size] for i in range(0, len(items), size)]
+    with ProcessPoolExecutor(workers) as executor:
+        parts = executor.map(calculate_metrics_chunk, chunks, repeat(summary_lines), repeat(requests_time))
+        return [metrics for part in parts for metrics in part]
+
+
+def calculate_report_metrics(config_file, urls, summary_lines, requests_time):
+    """function that calculates different metrics for each url.
+    Args:
+        config_file (dict): dict with parameters for searching.
+        urls (dict): dict with unique urls and their [count, time_sum, time_max, request times] records.
+        summary_lines (int): count of lines in file
+        requests_time (float): summary requests time of all urls in file.
+
+    Returns:
+        table list with dicts with urls and their metrics values.
+
+    """
+
+    logger.info('start calculating metrics')
+    items = select_report_items(config_file, list(urls.items()))
+    return calculate_table(items, summary_lines, requests_time)
+
+
+def build_report_table(config_file, samples, summary_lines, parsed_lines, requests_time):
+    """function that builds report table straight from collected samples.
+    Args:
+        config_file (dict): dict with parameters for searching.
+        samples (dict): dict with url bytes and array of their request times.
+        summary_lines (int): count of lines in file
+        parsed_lines (int): count of parsed lines in file
+        requests_time (float): summary requests time of all urls in file.
+
+    Returns:
+        table list with dicts with urls and their metrics values.
+
+    """
+    check_dropped(config_file, summary_lines, parsed_lines)
+    logger.info('start calculating metrics')
+    urls = decode_samples(samples)
+    items = [(url, [len(times), sum(times), max(times), times]) for url, times in urls.items()]
+    items = select_report_items(config_file, items)
+    return calculate_table(items, summary_lines, requests_time)
+
+
+@lru_cache(maxsize=8)
+def load_report_sample(sample_path):
+    """function that reads report sample once and splits it around the table placeholder.
+    Args:
+        sample_path (str): report sample path.
+
+    Returns:
+        parts of sample before and after the placeholder.
+
+    """
+    with open(sample_path, 'rb') as f:
+        head, placeholder, tail = f.read().partition(REPORT_PLACEHOLDER)
+    if not placeholder:
+        error_msg = f'report sample {sample_path} has no {REPORT_PLACEHOLDER.decode()} placeholder'
+        logger.error(error_msg)
+        raise RuntimeError(error_msg)
+    return head, tail
+
+
 def generate_report(config_file, table, file_date):
     """function that generate report with bad request time urls.
     Args:
@@ -177,13 +504,14 @@ def generate_report(config_file, table, file_date):
     file = f'report-{file_date.strftime("%Y")}.{file_date.strftime("%m")}.{file_date.strftime("%d")}.html'
     sample_path = os.path.join(ROOT_DIR, config_file['REPORT_SAMPLE'])
     report_path = os.path.join(ROOT_DIR, config_file['REPORT_DIR'], file)
-    with open(sample_path, 'r') as f:
-        with open(report_path, "w") as f1:
-            content = f.read()
-            tpl = Template(content)
-            new_report = tpl.safe_substitute(table_json=table)
-            f1.write(new_report)
-            logger.info(f'have successfully formed a report to the path {report_path}')
+    head, tail = load_report_sample(sample_path)
+    if orjson is None:
+        table_json = json.dumps(table, separators=(',', ':'), ensure_ascii=False).encode()
+    else:
+        table_json = orjson.dumps(table)
+    with open(report_path, 'wb') as f:
+        f.writelines((head, table_json, tail))
+    logger.info(f'have successfully formed a report to the path {report_path}')
 
 
 def report_is_exist(config_file, file_date):
@@ -199,9 +527,13 @@ def main(config_file):
     if report_is_exist(config_file, last_log_tuple.date):
         logger.info('have already analyzed the latest log')
         return
-    log_parser = parse_log(last_log_tuple.name)
-    urls, summary_lines, requests_time = aggregate_parse_values(config_file, log_parser)
-    metrics = calculate_report_metrics(config_file, urls, summary_lines, requests_time)
+    file = last_log_tuple.name
+    parallel = (os.cpu_count() or 1) > 1 and os.path.getsize(file) >= PARALLEL_PARSE_MIN_SIZE
+    if parallel and not file.endswith('.gz'):
+        samples = parse_log_parallel(file)
+    else:
+        samples = collect_samples(parse_log(file))
+    metrics = build_report_table(config_file, *samples)
     generate_report(config_file, metrics, last_log_tuple.date)
 
 
@@ -1,18 +1,48 @@
 import unittest
+import gzip
+import tempfile
+from unittest import mock
+from array import array
 from log_analyze.log_analyzer import *
 from log_analyze.definitions import ROOT_DIR
 
 
 class TestLogAnalyzer(unittest.TestCase):
+    file_name = 'nginx-access-ui.log-20170630'
+    urls = {'/api/v2/banner/25019354': [3, 1.17, 0.39, array('d', [0.39, 0.39, 0.39])],
+            '/api/1/photogenic_banners/list/?server_name=WIN7RB4': [1, 0.133, 0.133, array('d', [0.133])],
+            '/api/v2/banner/16852664': [1, 0.199, 0.199, array('d', [0.199])]}
+    table = \
+        [{'url': '/api/v2/banner/25019354', 'count': 3, 'time_sum': 1.17, 'time_avg': 0.38999999999999996,
+         'time_max': 0.39, 'time_med': 0.39, 'count_perc': 50.0, 'time_perc': 77.896},
+         {'url': '/api/1/photogenic_banners/list/?server_name=WIN7RB4', 'count': 1, 'time_sum': 0.133,
+         'time_avg': 0.133, 'time_max': 0.133, 'time_med': 0.133, 'count_perc': 16.667, 'time_perc': 8.855},
+         {'url': '/api/v2/banner/16852664', 'count': 1, 'time_sum': 0.199, 'time_avg': 0.199, 'time_max': 0.199,
+         'time_med': 0.199, 'count_perc': 16.667, 'time_perc': 13.249}]
+
+    @classmethod
+    def setUpClass(cls):
+        cls.config_path = os.path.join(ROOT_DIR, 'tests/resources/configs/config')
+        with open(cls.config_path, 'r') as f:
+            config = json.load(f)
+        cls.log_path = os.path.join(ROOT_DIR, config['LOG_DIR'], cls.file_name)
+        cls.parsed = list(parse_log(cls.log_path))
 
     def setUp(self):
-        with open(os.path.join(ROOT_DIR, 'tests/resources/configs/config'), 'r') as f:
+        with open(self.config_path, 'r') as f:
             self.config = json.load(f)
-        self.file_name = 'nginx-access-ui.log-20170630'
-        self.log_parser = parse_log(os.path.join(ROOT_DIR, self.config['LOG_DIR'], self.file_name))
+        self.log_parser = iter(self.parsed)
         self.file_date = datetime.datetime.strptime('20170630', '%Y%m%d').date()
         self.file_date_not = datetime.datetime.strptime('20170701', '%Y%m%d').date()
 
+    def setup_report_sample(self, tmp_dir):
+        sample_path = os.path.join(tmp_dir, 'report.html')
+        with open(sample_path, 'wb') as f:
+            f.write(b'<script>var table = $table_json;</script>')
+        self.config['REPORT_SAMPLE'] = sample_path
+        self.config['REPORT_DIR'] = tmp_dir
+        return os.path.join(tmp_dir, 'report-2017.06.30.html')
+
     def test_logger_setup_method_return(self):
         logger = logger_setup(self.config)
         assert isinstance(logger, logging.Logger)
@@ -29,8 +59,7 @@ class TestLogAnalyzer(unittest.TestCase):
         assert not find_latest_log(conf)
 
     def test_find_latest_log_success(self):
-        assert find_latest_log(self.config).name == \
-               os.path.join(ROOT_DIR, self.config['LOG_DIR'], self.file_name)
+        assert find_latest_log(self.config).name == self.log_path
 
     def test_aggregate_parse_values_assert_value_error(self):
         conf = self.config
@@ -39,18 +68,30 @@ class TestLogAnalyzer(unittest.TestCase):
             aggregate_parse_values(conf, self.log_parser)
 
     def test_aggregate_parse_values_urls(self):
-        test_urls = {'/api/v2/banner/25019354 ': [0.39, 0.39, 0.39],
-                     '/api/1/photogenic_banners/list/?server_name=WIN7RB4 ': [0.133],
-                     '/api/v2/banner/16852664 ': [0.199]}
         urls, summary_lines, requests_time = \
             aggregate_parse_values(self.config, self.log_parser)
-        assert urls == test_urls
+        assert urls == self.urls
+
+    def test_summarize_samples_url_decode(self):
+        samples = {'/é'.encode(): array('d', [0.1]), b'/\xe9': array('d', [0.2]), b'/\xff': array('d', [0.3])}
+        urls, summary_lines, requests_time = summarize_samples(self.config, samples, 3, 3, 0.6)
+        assert sorted(urls) == ['/\\xe9', '/\\xff', '/é']
+        table = build_report_table(self.config, samples, 3, 3, 0.6)
+        assert sorted(i['url'] for i in table) == ['/\\xe9', '/\\xff', '/é']
+
+    def test_summarize_samples_url_collision(self):
+        samples = {b'/\xe9': array('d', [0.2]), b'/\\xe9': array('d', [0.4, 0.3])}
+        urls, summary_lines, requests_time = summarize_samples(self.config, samples, 3, 3, 0.9)
+        assert urls == {'/\\xe9': [3, 0.9000000000000001, 0.4, array('d', [0.2, 0.4, 0.3])]}
+        table = build_report_table(self.config, samples, 3, 3, 0.9)
+        assert [(i['url'], i['count'], i['time_max']) for i in table] == [('/\\xe9', 3, 0.4)]
+        assert samples[b'/\xe9'] == array('d', [0.2])
 
     def test_aggregate_parse_values_summary_lines(self):
 
         urls, summary_lines, requests_time = aggregate_parse_values(
             self.config, self.log_parser)
-        assert summary_lines is 6
+        assert summary_lines == 6
 
     def test_aggregate_parse_values_request_time(self):
         urls, summary_lines, requests_time = aggregate_parse_values(
@@ -58,72 +99,139 @@ class TestLogAnalyzer(unittest.TestCase):
         assert requests_time == 1.5020000000000002
 
     def test_calculate_report_metrics_success(self):
-        urls = {'/api/v2/banner/25019354 ': [0.39, 0.39, 0.39],
-                '/api/1/photogenic_banners/list/?server_name=WIN7RB4 ': [0.133],
-                '/api/v2/banner/16852664 ': [0.199]}
-        summary_lines = 6
-        request_time = 1.5020000000000002
-        result_table = \
-            [{'url': '/api/v2/banner/25019354 ', 'count': 3, 'time_sum': 1.17, 'time_avg': 0.38999999999999996,
-             'time_max': 0.39, 'time_med': 0.39, 'count_perc': 50.0, 'time_perc': 77.896},
-             {'url': '/api/1/photogenic_banners/list/?server_name=WIN7RB4 ', 'count': 1, 'time_sum': 0.133,
-             'time_avg': 0.133, 'time_max': 0.133, 'time_med': 0.133, 'count_perc': 16.667, 'time_perc': 8.855},
-             {'url': '/api/v2/banner/16852664 ', 'count': 1, 'time_sum': 0.199, 'time_avg': 0.199, 'time_max': 0.199,
-             'time_med': 0.199, 'count_perc': 16.667, 'time_perc': 13.249}]
-        result = calculate_report_metrics(self.config, urls, summary_lines, request_time)
-        assert result_table == result
+        result = calculate_report_metrics(self.config, self.urls, 6, 1.5020000000000002)
+        assert result == self.table
 
     def test_calculate_report_metrics_len(self):
-        urls = {'/api/v2/banner/25019354 ': [0.39, 0.39, 0.39],
-                '/api/1/photogenic_banners/list/?server_name=WIN7RB4 ': [0.133],
-                '/api/v2/banner/16852664 ': [0.199]}
-        summary_lines = 6
-        request_time = 1.5020000000000002
         conf = self.config
         conf['REPORT_SIZE'] = 2
-        result = calculate_report_metrics(self.config, urls, summary_lines, request_time)
-        assert len(result) is 2
+        result = calculate_report_metrics(conf, self.urls, 6, 1.5020000000000002)
+        assert [i['url'] for i in result] == ['/api/v2/banner/25019354', '/api/v2/banner/16852664']
+
+    def test_calculate_medians_small(self):
+        records = [[3, 6.0, 3.0, array('d', [3.0, 1.0, 2.0])], [4, 10.0, 4.0, array('d', [4.0, 1.0, 3.0, 2.0])]]
+        assert calculate_medians(records) == [2.0, 2.5]
+
+    @unittest.skipIf(np is None, 'numpy not installed')
+    def test_calculate_medians_numpy(self):
+        records = []
+        for shift, counter in enumerate((32, 32, 33, 33, 100, 100, 5)):
+            times = array('d', [(i * 7 + shift) % 13 / 10 for i in range(counter)])
+            records.append([counter, sum(times), max(times), times])
+        assert calculate_medians(records) == [median(times) for _, _, _, times in records]
+
+    def test_calculate_table_parallel(self):
+        items = [(f'/api/{i}', [i + 1, i + 1.5, 1.5, array('d', [1.5] + [1.0] * i)]) for i in range(10)]
+        expected_table = calculate_metrics_chunk(items, 100, 100.0)
+        with mock.patch('log_analyze.log_analyzer.PARALLEL_METRICS_MIN_URLS', 1), \
+                mock.patch('os.cpu_count', return_value=3):
+            assert calculate_table(items, 100, 100.0) == expected_table
+
+    def test_build_report_table(self):
+        urls, summary_lines, requests_time = aggregate_parse_values(self.config, iter(self.parsed))
+        expected_table = calculate_report_metrics(self.config, urls, summary_lines, requests_time)
+        assert build_report_table(self.config, *collect_samples(self.log_parser)) == expected_table
 
     def test_generate_report_success(self):
-        table = \
-            [{'url': '/api/v2/banner/25019354 ', 'count': 3, 'time_sum': 1.17, 'time_avg': 0.38999999999999996,
-             'time_max': 0.39, 'time_med': 0.39, 'count_perc': 50.0, 'time_perc': 77.896},
-             {'url': '/api/1/photogenic_banners/list/?server_name=WIN7RB4 ', 'count': 1, 'time_sum': 0.133,
-             'time_avg': 0.133, 'time_max': 0.133, 'time_med': 0.133, 'count_perc': 16.667, 'time_perc': 8.855},
-             {'url': '/api/v2/banner/16852664 ', 'count': 1, 'time_sum': 0.199, 'time_avg': 0.199, 'time_max': 0.199,
-             'time_med': 0.199, 'count_perc': 16.667, 'time_perc': 13.249}]
-        result_report = os.path.join(ROOT_DIR, self.config['REPORT_DIR'], 'report-2017.06.30.html')
-        if os.path.exists(result_report):
-            os.remove(result_report)
-        generate_report(self.config, table, self.file_date)
-        assert os.path.exists(result_report)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            result_report = self.setup_report_sample(tmp_dir)
+            generate_report(self.config, self.table, self.file_date)
+            assert os.path.exists(result_report)
 
     def test_generate_report_table_substitution(self):
-        result_report = os.path.join(ROOT_DIR, self.config['REPORT_DIR'], 'report-2017.06.30.html')
-        value = "var table = [{'url': '/api/v2/banner/25019354 ', 'count': 3, 'time_sum': 1.17, "\
-                "'time_avg': 0.38999999999999996, 'time_max': 0.39, 'time_med': 0.39, 'count_perc': 50.0, " \
-                "'time_perc': 77.896}, {'url': '/api/1/photogenic_banners/list/?server_name=WIN7RB4 ', 'count': 1, " \
-                "'time_sum': 0.133, 'time_avg': 0.133, 'time_max': 0.133, 'time_med': 0.133, 'count_perc': 16.667, " \
-                "'time_perc': 8.855}, {'url': '/api/v2/banner/16852664 ', 'count': 1, 'time_sum': 0.199, " \
-                "'time_avg': 0.199, 'time_max': 0.199, 'time_med': 0.199, 'count_perc': 16.667, 'time_perc': 13.249}];"
-        with open(result_report, 'r') as f:
-            assert value in f.read()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            result_report = self.setup_report_sample(tmp_dir)
+            generate_report(self.config, self.table, self.file_date)
+            with open(result_report, 'rb') as f:
+                head, _, table_json = f.read().partition(b'var table = ')
+        table_json, _, tail = table_json.rpartition(b';')
+        assert head == b'<script>' and tail == b'</script>'
+        assert json.loads(table_json) == self.table
+
+    def test_generate_report_bytes(self):
+        table = [{'url': '/é', 'count': 1, 'time_sum': 0.5}]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            result_report = self.setup_report_sample(tmp_dir)
+            generate_report(self.config, table, self.file_date)
+            with open(result_report, 'rb') as f:
+                report = f.read()
+        assert report == b'<script>var table = [{"url":"/\xc3\xa9","count":1,"time_sum":0.5}];</script>'
+
+    def test_generate_report_no_placeholder(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            result_report = self.setup_report_sample(tmp_dir)
+            with open(self.config['REPORT_SAMPLE'], 'wb') as f:
+                f.write(b'<script>var table = [];</script>')
+            with self.assertRaises(RuntimeError):
+                generate_report(self.config, self.table, self.file_date)
+            assert not os.path.exists(result_report)
 
     def test_parse_log(self):
-        gen = parse_log(os.path.join(ROOT_DIR, self.config['LOG_DIR'], self.file_name))
+        gen = parse_log(self.log_path)
         summary_lines = parsed_lines = 0
         for i, j, x in gen:
             summary_lines = j
             parsed_lines = x
         assert summary_lines == 6 and parsed_lines == 5
 
+    def test_parse_lines_request_time(self):
+        line = b'1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/25019354 HTTP/1.1" 200 927 ' \
+               b'"-" "Lynx/2.8.8dev.9" "-" "1498697422-2190034393-4708-9752759" "dc7161be3" '
+        lines = [line + value for value in (b'nan', b'inf', b'-1.0', b'1e3', b'1.', b'.5', b'0.390 ', b'0.133\r')]
+        assert parse_lines(lines) == [(b'/api/v2/banner/25019354', 0.39), (b'/api/v2/banner/25019354', 0.133)]
+
+    def test_parse_log_gz(self):
+        with open(self.log_path, 'rb') as f:
+            content = f.read()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            gz_file = os.path.join(tmp_dir, f'{self.file_name}.gz')
+            with gzip.open(gz_file, 'wb') as f:
+                f.write(content)
+            summary_lines = parsed_lines = 0
+            for i, j, x in parse_log(gz_file):
+                summary_lines = j
+                parsed_lines = x
+        assert summary_lines == 6 and parsed_lines == 5
+
+    def test_parse_log_gz_padded(self):
+        with open(self.log_path, 'rb') as f:
+            content = f.read()
+        middle = content.index(b'\n', len(content) // 2) + 1
+        padded = gzip.compress(content[:middle]) + b'\0' * 8 + gzip.compress(content[middle:]) + b'\0' * 8
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            gz_file = os.path.join(tmp_dir, f'{self.file_name}.gz')
+            with open(gz_file, 'wb') as f:
+                f.write(padded)
+            for read_size in (READ_SIZE, 7):
+                with mock.patch('log_analyze.log_analyzer.READ_SIZE', read_size):
+                    summary_lines = parsed_lines = 0
+                    for i, j, x in parse_log(gz_file):
+                        summary_lines = j
+                        parsed_lines = x
+                assert summary_lines == 6 and parsed_lines == 5
+
+    def test_parse_log_parallel(self):
+        samples, summary_lines, parsed_lines, requests_time = parse_log_parallel(self.log_path, workers=3)
+        expected_samples, _, _, expected_requests_time = collect_samples(parse_log(self.log_path))
+        assert samples == expected_samples
+        assert summary_lines == 6 and parsed_lines == 5
+        assert round(requests_time, 9) == round(expected_requests_time, 9)
+
     def test_update_config(self):
         config = {
             'REPORT_SIZE': 50,
             'MAX_DROP': 5
         }
-        update_config(os.path.join(ROOT_DIR, 'tests/resources/configs/config'), config)
+        update_config(self.config_path, config)
         expected_config = \
             {'REPORT_SIZE': 1000, 'MAX_DROP': 20, 'REPORT_DIR': 'tests/resources/REPORTS_DIR/',
              'REPORT_SAMPLE': 'resources/REPORT_SAMPLE/report.html', 'LOG_DIR': 'tests/resources/LOG_DIR/'}
         assert config == expected_config
+
+    def test_update_config_cached_copy(self):
+        config = {}
+        update_config(self.config_path, config)
+        config['MAX_DROP'] = 0
+        config_again = {}
+        update_config(self.config_path, config_again)
+        assert config_again['MAX_DROP'] == 20